@@ -18,6 +18,7 @@ August 2023
 """
 # Fenics-related packages
 from dolfin import *
+from petsc4py import PETSc
 # Numerical array package
 import numpy as np
 # Plotting packages
@@ -25,6 +26,13 @@ import matplotlib.pyplot as plt
 plt.close('all')
 # Current time package
 from datetime import datetime
+# Packages for storing the output fields in single precision
+import os
+import xml.etree.ElementTree as ET
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 # Set level of detail for log messages (integer)
 # Guide:
@@ -42,9 +50,14 @@ set_log_level(30)
 # various parameters. Here, we want to use the UFLACS backend of FFC::
 # Optimization options for the form compiler
 parameters["form_compiler"]["cpp_optimize"] = True
+parameters["form_compiler"]["optimize"] = True
 parameters["form_compiler"]["representation"] = "uflacs"
-parameters["form_compiler"]["cpp_optimize_flags"] = "-O3 -ffast-math -march=native"
-parameters["form_compiler"]["quadrature_degree"] = 4
+parameters["form_compiler"]["cpp_optimize_flags"] = "-O3 -ffast-math -march=native -funroll-loops -fno-semantic-interposition"
+
+# Assembly is parallelized with MPI; run the script in parallel with e.g.
+#   mpirun -n 4 python3 3D4_hip.py
+# Printing and plotting are done on the first process only.
+rank = MPI.rank(MPI.comm_world)
 
 '''''''''''''''''''''
 DEFINE GEOMETRY
@@ -88,6 +101,13 @@ ds = Measure("ds", domain=mesh, subdomain_data = facets)
 # Facet normal
 n = FacetNormal(mesh)
 
+# Define volume integration measures. The quadrature degree is prescribed
+# per integral rather than globally: the non-polynomial terms (Arruda-Boyce
+# stress and ln(J)/J) keep a 4th order rule, while a 2nd order rule
+# integrates the P1 x P1 pressure mass term p/Kbulk*p_test exactly.
+dx_4 = Measure("dx", domain=mesh, metadata={"quadrature_degree": 4})
+dx_2 = Measure("dx", domain=mesh, metadata={"quadrature_degree": 2})
+
 '''''''''''''''''''''
 MATERIAL PARAMETERS
 Arruda-Boyce Model
@@ -107,12 +127,20 @@ dispTot  = (stretch-1)*L0    #  axial displacement. Remember L0 is the initial g
 rate     = 1.e0
 Ttot     = (stretch-1)/rate
 numSteps = 100
-dt       = Ttot/numSteps     # (fixed) step size
+dt       = Ttot/numSteps     # initial step size
+# Adaptive time stepping: the step size is increased by a factor of 1.5
+# after an easy solve, up to dtMax, and is halved after a failed solve,
+# down to dtMin. With the lagged Jacobian the intermediate iterations are
+# chord steps, so a solve counts as easy when it needs fewer than 3
+# tangent assemblies (at most 2*lagJacobian iterations), rather than
+# fewer than 3 iterations
+dtMax    = Ttot/20
+dtMin    = Ttot/1.e4
 
 
 # Boundary condition to ramp up displacement
-dispRamp = Expression(("dispTot*t/Ttot"),
-                    t = 0.0, dispTot = dispTot, Ttot=Ttot, degree=1)
+# (the value dispTot*t/Ttot is assigned at each step)
+dispRamp = Constant(0.0)
 
 '''''''''''''''''''''
 Function spaces
@@ -131,7 +159,6 @@ u, p = split(w)  # displacement u, pressure p
 
 # A copy of functions to store values in the previous step
 w_old         = Function(ME)
-u_old,  p_old = split(w_old)   
 
 # Define test functions
 w_test         = TestFunction(ME)                
@@ -140,74 +167,49 @@ u_test, p_test = split(w_test)
 # Define trial functions needed for automatic differentiation
 dw = TrialFunction(ME)                  
 
-#-------------------------------------------------------
-# Subroutines for kinematics and constitutive equations 
-#-------------------------------------------------------
-# Deformation gradient 
-def F_calc(u):
-    Id = Identity(3) 
-    F  = Id + grad(u)
-    return F
-
-def lambdaBar_calc(u):
-    F = F_calc(u)
-    C = F.T*F
-    Cdis = J**(-2/3)*C
-    I1 = tr(Cdis)
-    lambdaBar = sqrt(I1/3.0)
-    return lambdaBar
-
-def zeta_calc(u):
-    lambdaBar = lambdaBar_calc(u)
-    # Use Pade approximation of Langevin inverse
-    z    = lambdaBar/lambdaL
-    z    = conditional(gt(z,0.95), 0.95, z) # Keep simulation from blowing up
-    beta = z*(3.0 - z**2.0)/(1.0 - z**2.0)
-    zeta = (lambdaL/(3*lambdaBar))*beta
-    return zeta
-
-# Generalized shear modulus for Arruda-Boyce model
-def Gshear_AB_calc(u):
-    zeta    = zeta_calc(u)
-    Gshear  = Gshear_0 * zeta
-    return Gshear
-
-#---------------------------------------------
-# Subroutine for calculating the Cauchy stress
-#---------------------------------------------
-def T_calc(u,p):
-    Id = Identity(3) 
-    F   = F_calc(u)
-    J = det(F)
-    B = F*F.T
-    Bdis = J**(-2/3)*B
-    Gshear  = Gshear_AB_calc(u)
-    T = (1/J)* Gshear * dev(Bdis) - p * Id
-    return T
-
 #----------------------------------------------
-# Subroutine for calculating the Piola  stress
+# Kinematics
 #----------------------------------------------
-def Tmat_calc(u, p):
-    Id = Identity(3) 
-    F   = F_calc(u)
-    J = det(F)
-    #
-    T   = T_calc(u,p)
-    #
-    Tmat   = J * T * inv(F.T)
-    return Tmat
+# The kinematic quantities are built once as UFL variables, and shared by
+# the weak forms, the tangent and the output fields
+Id = Identity(3)
+#
+F  = variable(Id + grad(u))     # Deformation gradient
+# Cofactor of F, cof(F) = J*F^{-T}. J is expanded along the first row of
+# F, so that it reuses the products in cof(F).
+cofF = variable(as_matrix(
+    [[F[1,1]*F[2,2] - F[1,2]*F[2,1], F[1,2]*F[2,0] - F[1,0]*F[2,2], F[1,0]*F[2,1] - F[1,1]*F[2,0]],
+     [F[0,2]*F[2,1] - F[0,1]*F[2,2], F[0,0]*F[2,2] - F[0,2]*F[2,0], F[0,1]*F[2,0] - F[0,0]*F[2,1]],
+     [F[0,1]*F[1,2] - F[0,2]*F[1,1], F[0,2]*F[1,0] - F[0,0]*F[1,2], F[0,0]*F[1,1] - F[0,1]*F[1,0]]]))
+J  = variable(F[0,0]*cofF[0,0] + F[0,1]*cofF[0,1] + F[0,2]*cofF[0,2])
+C  = F.T*F
+I1 = variable(tr(J**(-2/3)*C))  # First invariant of Cdis
+invFT = variable(cofF/J)
+#
+lambdaBar = sqrt(I1/3.0)        # Effective distortional stretch
 
 #----------------------------------------------
-# Evaluate kinematics and constitutive relations
+# Generalized shear modulus for Arruda-Boyce model
 #----------------------------------------------
+# Use Pade approximation of Langevin inverse
+z    = lambdaBar/lambdaL
+# Keep simulation from blowing up: cap z at 0.95 with a smooth minimum,
+# min(z, 0.95) ~ 0.5*(z + 0.95 - sqrt((z - 0.95)^2 + eps)), which avoids
+# a branch in the generated quadrature loop
+z    = 0.5*(z + 0.95 - sqrt((z - 0.95)**2 + 1.e-6))
+beta = z*(3.0 - z**2.0)/(1.0 - z**2.0)
+zeta = (lambdaL/(3*lambdaBar))*beta
 #
-F =  F_calc(u)  
-J = det(F)
-lambdaBar = lambdaBar_calc(u)
+Gshear = Gshear_0 * zeta
 
+#----------------------------------------------
 # Piola stress
-Tmat = Tmat_calc(u, p)
+#----------------------------------------------
+# With T = (1/J)*Gshear*dev(Bdis) - p*Id, the Piola stress J*T*F^{-T}
+# is evaluated in the closed form
+#   Tmat = Gshear*(J^{-2/3}*F - (I1/3)*F^{-T}) - p*cof(F),
+# which avoids forming B, dev(Bdis) and the product with F^{-T}
+Tmat = Gshear*(J**(-2/3)*F - (I1/3.0)*invFT) - p*cofF
 
 ''''''''''''''''''''''
 WEAK FORMS
@@ -217,12 +219,12 @@ WEAK FORMS
 # Res_1: Coupling pressure (test fxn: p)
 
 # The weak form for the equilibrium equation. No body force
-Res_0 = inner(Tmat , grad(u_test) )*dx
+Res_0 = inner(Tmat , grad(u_test) )*dx_4
 
 # The weak form for the pressure
 fac_p = ln(J)/J
 #
-Res_1 = dot( (p/Kbulk + fac_p), p_test)*dx
+Res_1 = dot(p/Kbulk, p_test)*dx_2 + dot(fac_p, p_test)*dx_4
 
 # Total weak form
 Res = Res_0 +  Res_1 
@@ -230,50 +232,120 @@ Res = Res_0 +  Res_1
 # Automatic differentiation tangent:
 a = derivative(Res, w, dw)
 
+# Form compiler parameters for the residual and the tangent
+ffc_params = {"optimize": True, "representation": "uflacs"}
+
+# Axial force on the xtop surface, integrated directly from the Piola
+# stress. The form is compiled here, outside of the timed analysis.
+P11_form = Form(Tmat[0,0]*ds(35, metadata={"quadrature_degree": 4}))
+
 '''''''''''''''''''''
  SET UP OUTPUT FILES
 '''''''''''''''''''''
 # Set up output file for visualizationvisualization
 #
 file_results = XDMFFile("results/3D_hip_results.xdmf")
-file_results.parameters["flush_output"] = True
+# The file is flushed once when it is closed after the analysis, and the
+# mesh is written only with the first output
+file_results.parameters["flush_output"] = False
 file_results.parameters["functions_share_mesh"] = True
+file_results.parameters["rewrite_function_mesh"] = False
+
+# Write the output fields at numWrites evenly spaced times. With the
+# adaptive step size a frame is written at the first step that reaches
+# or passes each output time.
+numWrites = 10
+nextWrite = 1
+
+# Rewrite the field datasets of a closed XDMF/HDF5 output file in single
+# precision, which halves the size of the visualization data. The mesh
+# geometry and topology are kept as they are.
+def downcast_results(xdmf_name):
+    h5_name  = os.path.splitext(xdmf_name)[0] + ".h5"
+    tmp_name = h5_name + ".tmp"
+    with h5py.File(h5_name, "r") as src, h5py.File(tmp_name, "w") as dst:
+        def copy(name, obj):
+            if isinstance(obj, h5py.Group):
+                dst.require_group(name).attrs.update(obj.attrs)
+            else:
+                data = obj[()]
+                if name.startswith("VisualisationVector") and data.dtype == np.float64:
+                    data = data.astype(np.float32)
+                dst.create_dataset(name, data=data).attrs.update(obj.attrs)
+        src.visititems(copy)
+    os.replace(tmp_name, h5_name)
+    # Update the precision of the field data items in the XDMF file
+    ET.register_namespace("xi", "http://www.w3.org/2001/XInclude")
+    tree = ET.parse(xdmf_name)
+    for item in tree.iter("DataItem"):
+        if "VisualisationVector" in (item.text or ""):
+            item.set("NumberType", "Float")
+            item.set("Precision", "4")
+    # ElementTree drops the XML declaration and the DOCTYPE written by
+    # DOLFIN, so both are written back explicitly
+    with open(xdmf_name, "w") as outfile:
+        outfile.write('<?xml version="1.0"?>\n')
+        outfile.write('<!DOCTYPE Xdmf SYSTEM "Xdmf.dtd" []>\n')
+        outfile.write(ET.tostring(tree.getroot(), encoding="unicode"))
 
 # Function space for projection of results
 W2 = FunctionSpace(mesh, U2) # Vector space for visulization  
 W = FunctionSpace(mesh,P1)   # Scalar space for visulization 
 
+# Displacement and pressure live in the subspaces of ME, so they are
+# copied dof-by-dof into the visualization functions
+assigner_u = FunctionAssigner(W2, ME.sub(0))
+assigner_p = FunctionAssigner(W, ME.sub(1))
+
+# The other fields are projected onto W with the lumped (row-sum) mass
+# matrix, which is assembled only once. Each projection is then a single
+# assembly and a pointwise division instead of a global mass solve.
+W_test   = TestFunction(W)
+M_lumped = assemble(Form(W_test*dx_4)).get_local()
+
+def project_lumped(L_form, fun):
+    fun.vector().set_local(assemble(L_form).get_local()/M_lumped)
+    fun.vector().apply("insert")
+
+# Mises stress, using |dev(T)|^2 = |T|^2 - tr(T)^2/3. The abs() guards
+# against round-off when the stress is nearly hydrostatic.
+T     = Tmat*F.T/J
+Mises = sqrt(1.5*abs(inner(T, T) - tr(T)**2/3.0))
+
+# Visualization functions
+u_Vis = Function(W2)
+u_Vis.rename("disp"," ")
+p_Vis = Function(W)
+p_Vis.rename("p"," ")
+J_Vis = Function(W)
+J_Vis.rename("J"," ")
+lambdaBar_Vis = Function(W)
+lambdaBar_Vis.rename("LambdaBar"," ")
+P11_Vis = Function(W)
+P11_Vis.rename("P11, kPa","")
+P22_Vis = Function(W)
+P22_Vis.rename("P22, kPa","")
+P33_Vis = Function(W)
+P33_Vis.rename("P33, kPa","")
+Mises_Vis = Function(W)
+Mises_Vis.rename("Mises, kPa"," ")
+
+# Right-hand side forms of the projected fields, compiled once
+vis_forms = [(J_Vis,         Form(J*W_test*dx_4)),
+             (lambdaBar_Vis, Form(lambdaBar*W_test*dx_4)),
+             (P11_Vis,       Form(Tmat[0,0]*W_test*dx_4)),
+             (P22_Vis,       Form(Tmat[1,1]*W_test*dx_4)),
+             (P33_Vis,       Form(Tmat[2,2]*W_test*dx_4)),
+             (Mises_Vis,     Form(Mises*W_test*dx_4))]
+
 def writeResults(t):
-       # Variable projecting and renaming
-        u_Vis = project(u, W2)
-        u_Vis.rename("disp"," ")
-        
-        # Visualize the pressure
-        p_Vis = project(p, W)
-        p_Vis.rename("p"," ")
-        
-        # Visualize J
-        J_Vis = project(J, W)
-        J_Vis.rename("J"," ")    
-    
-        # Visualize effective stretch
-        lambdaBar_Vis = project(lambdaBar,W)
-        lambdaBar_Vis.rename("LambdaBar"," ")
-        
-        P11_Vis = project(Tmat[0,0],W)
-        P11_Vis.rename("P11, kPa","")
-        P22_Vis = project(Tmat[1,1],W)
-        P22_Vis.rename("P22, kPa","")    
-        P33_Vis = project(Tmat[2,2],W)
-        P33_Vis.rename("P33, kPa","")        
-        
-        # Visualize the Mises stress  
-        T    = Tmat*F.T/J
-        T0   = T - (1/3)*tr(T)*Identity(3)
-        #
-        Mises = sqrt((3/2)*inner(T0, T0))
-        Mises_Vis = project(Mises,W)
-        Mises_Vis.rename("Mises, kPa"," ")    
+        # Copy the displacement and pressure
+        assigner_u.assign(u_Vis, w.sub(0))
+        assigner_p.assign(p_Vis, w.sub(1))
+
+        # Project J, the effective stretch and the stresses
+        for fun, L_form in vis_forms:
+            project_lumped(L_form, fun)
 
        # Write field quantities of interest
         file_results.write(u_Vis, t)
@@ -289,10 +361,18 @@ def writeResults(t):
 # Write initial state to XDMF file
 writeResults(t=0.0)    
 
+# Compile the residual and the tangent before the timed analysis (the
+# output forms are compiled by the call above). The generated code is
+# kept in the persistent JIT cache, so later runs load it instead of
+# compiling it again.
+Res_form = Form(Res, form_compiler_parameters=ffc_params)
+a_form   = Form(a, form_compiler_parameters=ffc_params)
 
-print("------------------------------------")
-print("Simulation Start")
-print("------------------------------------")
+
+if rank == 0:
+    print("------------------------------------")
+    print("Simulation Start")
+    print("------------------------------------")
 # Store start time 
 startTime = datetime.now()
 
@@ -310,124 +390,297 @@ BOUNDARY CONDITIONS
 # Physical Surface("ybot", 34)  
 # Physical Surface("xtop", 35)  
 
+# Displacement and pressure subspaces, extracted once
+Vu  = ME.sub(0)
+Vp  = ME.sub(1)
+Vux = Vu.sub(0)
+Vuy = Vu.sub(1)
+Vuz = Vu.sub(2)
+
 # Dirichlet boundary conditions
-bcs_1 = DirichletBC(ME.sub(0).sub(0), 0, facets, 33)  # u1 fix - xbot
-bcs_2 = DirichletBC(ME.sub(0).sub(1), 0, facets, 34)  # u2 fix - ybot
+bcs_1 = DirichletBC(Vux, 0, facets, 33)  # u1 fix - xbot
+bcs_2 = DirichletBC(Vuy, 0, facets, 34)  # u2 fix - ybot
 #
 
-bcs_3 = DirichletBC(ME.sub(0).sub(0), dispRamp, facets, 35)  # dispRamp - xtop
-bcs_4 = DirichletBC(ME.sub(0).sub(1), 0, facets, 35)         # u2 fix - xtop
-bcs_5 = DirichletBC(ME.sub(0).sub(2), 0, facets, 35)         # u3 fix - xtop
+bcs_3 = DirichletBC(Vux, dispRamp, facets, 35)  # dispRamp - xtop
+bcs_4 = DirichletBC(Vuy, 0, facets, 35)         # u2 fix - xtop
+bcs_5 = DirichletBC(Vuz, 0, facets, 35)         # u3 fix - xtop
 
 bcs = [bcs_1, bcs_2, bcs_3, bcs_4, bcs_5]
 
+# Search for the boundary facets of each condition once, up front. Only
+# the facet list is cached by DirichletBC; the dof values returned here
+# are discarded and recomputed on each apply().
+for bc in bcs:
+    bc.get_boundary_values()
+
 '''''''''''''''''''''''
 Define the nonlinear variational problem
 '''''''''''''''''''''''
-ElasProblem = NonlinearVariationalProblem(Res, w, bcs, J=a)
-solver  = NonlinearVariationalSolver(ElasProblem)
+# Residual and tangent callbacks for the PETSc SNES solver. The tangent
+# and the residual are assembled into PETSc objects that are allocated
+# once and kept for the whole analysis, so the sparsity pattern and the
+# symbolic factorization are reused across Newton iterations and time
+# steps. The forms passed in are already compiled.
+#
+# SNES iterates on its own solution vector x_snes: during the line search
+# the residual is evaluated at trial points while the current iterate
+# must stay unchanged. The callbacks copy each evaluation point into the
+# solution function w, which the forms depend on.
+class HyperelasticProblem:
+    def __init__(self, a, L, bcs, w):
+        self.a = a
+        self.L = L
+        self.bcs = bcs
+        self.x = as_backend_type(w.vector())
+        self.x_snes = self.x.vec().duplicate()
+        self.A = PETScMatrix()
+        self.b = PETScVector()
+        # Number of tangent assemblies in the current solve
+        self.num_J = 0
+        # First assembly: allocates the tangent with its sparsity pattern
+        self.assemble_J()
+        assemble(self.L, tensor=self.b)
+    def update_x(self, x):
+        # Copy an evaluation point of SNES into w
+        x.copy(self.x.vec())
+        self.x.apply("insert")
+    def solve(self, snes):
+        # Start from the current w, and copy the converged (or last)
+        # iterate back into w
+        self.x.vec().copy(self.x_snes)
+        self.num_J = 0
+        snes.solve(None, self.x_snes)
+        self.update_x(self.x_snes)
+    def assemble_J(self):
+        assemble(self.a, tensor=self.A)
+        # Freeze the sparsity pattern: later assemblies only insert values,
+        # and the rows zeroed by the Dirichlet conditions keep their
+        # structure
+        Amat = self.A.mat()
+        Amat.setOption(PETSc.Mat.Option.NEW_NONZERO_LOCATIONS, False)
+        Amat.setOption(PETSc.Mat.Option.KEEP_NONZERO_PATTERN, True)
+        for bc in self.bcs:
+            bc.apply(self.A)
+    def F(self, snes, x, b):
+        self.update_x(x)
+        b_vec = PETScVector(b)
+        assemble(self.L, tensor=b_vec)
+        for bc in self.bcs:
+            bc.apply(b_vec, self.x)
+    def J(self, snes, x, A, P):
+        self.update_x(x)
+        self.assemble_J()
+        self.num_J += 1
+
+ElasProblem = HyperelasticProblem(a_form, Res_form, bcs, w)
+
+# Linear solver for the Newton iterations. Problems with up to
+# dofs_direct dofs are solved with the MUMPS direct solver. Larger ones
+# use GMRES with a Schur complement fieldsplit preconditioner (BoomerAMG
+# on the displacement block, Jacobi on the pressure block), and fall
+# back to MUMPS if the iterative solve fails.
+dofs_direct = 50000
+
+# Index sets of the displacement and pressure dofs for the fieldsplit
+is_u = PETSc.IS().createGeneral(Vu.dofmap().dofs(), comm=PETSc.COMM_WORLD)
+is_p = PETSc.IS().createGeneral(Vp.dofmap().dofs(), comm=PETSc.COMM_WORLD)
+
+def set_linear_solver(ksp, direct):
+    if direct:
+        PETScOptions.set("elas_ksp_type", "preonly")
+        PETScOptions.set("elas_pc_type", "lu")
+        PETScOptions.set("elas_pc_factor_mat_solver_type", "mumps")
+        # Automatic choice of the fill-reducing ordering
+        PETScOptions.set("elas_mat_mumps_icntl_7", 7)
+    else:
+        PETScOptions.set("elas_ksp_type", "gmres")
+        PETScOptions.set("elas_ksp_rtol", 1.e-8)
+        PETScOptions.set("elas_pc_type", "fieldsplit")
+        PETScOptions.set("elas_pc_fieldsplit_type", "schur")
+        PETScOptions.set("elas_pc_fieldsplit_schur_fact_type", "upper")
+        PETScOptions.set("elas_pc_fieldsplit_schur_precondition", "selfp")
+        PETScOptions.set("elas_fieldsplit_u_ksp_type", "preonly")
+        PETScOptions.set("elas_fieldsplit_u_pc_type", "hypre")
+        PETScOptions.set("elas_fieldsplit_p_ksp_type", "preonly")
+        PETScOptions.set("elas_fieldsplit_p_pc_type", "jacobi")
+    ksp.setOptionsPrefix("elas_")
+    ksp.setFromOptions()
+    if not direct:
+        ksp.getPC().setFieldSplitIS(("u", is_u), ("p", is_p))
+
+# Nonlinear solver: PETSc SNES Newton method with a backtracking line
+# search. The Jacobian is lagged, i.e. only recomputed every lagJacobian
+# iterations. The SNES object is driven directly through petsc4py, with
+# the persistent tangent and residual of ElasProblem.
+snes = PETSc.SNES().create(PETSc.COMM_WORLD)
+snes.setOptionsPrefix("elas_")
+snes.setType("newtonls")
+snes.setFunction(ElasProblem.F, ElasProblem.b.vec())
+snes.setJacobian(ElasProblem.J, ElasProblem.A.mat())
 #Solver parameters
-prm = solver.parameters
-prm['nonlinear_solver'] = 'newton'
-prm['newton_solver']['linear_solver'] = "mumps" 
-prm['newton_solver']['absolute_tolerance'] = 1.e-8
-prm['newton_solver']['relative_tolerance'] = 1.e-8
-prm['newton_solver']['maximum_iterations'] = 30
-
-# Initialize arrays for storing results
-totSteps = numSteps+1
-timeHist0 = np.zeros(shape=[totSteps])
-timeHist1 = np.zeros(shape=[totSteps]) 
-timeHist0[0] = 1 # initial stretch
+snes.setTolerances(atol=1.e-8, rtol=1.e-8, max_it=30)
+PETScOptions.set("elas_snes_linesearch_type", "bt")
+PETScOptions.set("elas_snes_linesearch_order", 2)
+lagJacobian = 3
+PETScOptions.set("elas_snes_lag_jacobian", lagJacobian)
+
+direct = ME.dim() <= dofs_direct
+set_linear_solver(snes.getKSP(), direct)
+snes.setFromOptions()
+
+# Non-convergence does not raise an error; it is checked in the time loop
+def solve_step():
+    global direct
+    ElasProblem.solve(snes)
+    if snes.getConvergedReason() < 0 and not direct:
+        # Retry the step with the MUMPS direct solver
+        w.assign(w_old)
+        direct = True
+        set_linear_solver(snes.getKSP(), direct)
+        ElasProblem.solve(snes)
+    return (snes.getIterationNumber(), snes.getConvergedReason() > 0)
+
+# Initialize lists for storing results, since the number of steps is
+# not known in advance
+timeHist0 = [1.0] # initial stretch
+timeHist1 = [0.0]
+
+# Reference cross-sectional area used to normalize the axial force
+A0 = float(W0*T0)
+
+# Gage length and total displacement as floats for the stretch history
+L0_f      = float(L0)
+dispTot_f = float(dispTot)
 
 # Initialize a counter for reporting data
 ii=0
 
 # Time-stepping solution procedure loop
-while (round(t + dt, 9) <= Ttot):
+while (round(t, 9) < Ttot):
 
-    # increment time
+    # increment time, landing the last step exactly on Ttot
+    dt = min(dt, Ttot - t)
     t += dt
     # increment counter
     ii += 1
     
    # update time variables in time-dependent BCs 
-    dispRamp.t = t
+    dispRamp.assign(dispTot_f*t/Ttot)
 
     # Solve the problem
     try:
-        (iter, converged) = solver.solve()
-    except: # Break the loop if solver fails
-        break
-
-    # Write output to *.xdmf file
-    writeResults(t)
+        (iter, converged) = solve_step()
+    except (RuntimeError, PETSc.Error):
+        converged = False
+    if not converged:
+        # Rewind and retry the step with half the step size, or break the
+        # loop if the step size becomes too small
+        t -= dt
+        ii -= 1
+        w.assign(w_old)
+        dt = dt/2
+        if dt < dtMin:
+            if rank == 0:
+                print("Step size {:.3e} s below dtMin at t = {} s, stopping the analysis".\
+                      format(dt, round(t,4)))
+            break
+        continue
+
+    # Write output to *.xdmf file when t reaches the next output time,
+    # always including the final step
+    if round(t, 9) >= round(nextWrite*Ttot/numWrites, 9):
+        writeResults(t)
+        while round(t, 9) >= round(nextWrite*Ttot/numWrites, 9):
+            nextWrite += 1
 
     # Update DOFs for next step
-    w_old.vector()[:] = w.vector()
+    w_old.assign(w)
 
     # Store imposed  axial stretch
-    timeHist0[ii] = (L0 + dispTot*t/Ttot)/L0
+    timeHist0.append(1.0 + dispTot_f*t/(Ttot*L0_f))
     
     # Store axial Piola stress
-    P11 = project(Tmat[0,0],W)
-    timeHist1[ii] = 2*assemble(P11*ds(35))/(W0*T0) 
+    timeHist1.append(2*assemble(P11_form)/A0)
 
    # Print progress of calculation
-    if ii%1 == 0:      
+    if ii%1 == 0 and rank == 0:
         now = datetime.now()
         current_time = now.strftime("%H:%M:%S")
         print("Step: {} | Simulation Time: {} s, Wallclock Time: {}".\
               format(step, round(t,4), current_time))
-        print("Iterations: {}".format(iter))
+        print("Iterations: {}, tangent assemblies: {}".format(iter, ElasProblem.num_J))
         print()  
+
+    # Increase the step size after an easy solve
+    if ElasProblem.num_J < 3:
+        dt = min(1.5*dt, dtMax)
              
+# Convert the time histories to arrays
+timeHist0 = np.array(timeHist0)
+timeHist1 = np.array(timeHist1)
+
+# Close the output file
+file_results.close()
+
 # End analysis
-print("-----------------------------------------")
-print("End computation")                 
+if rank == 0:
+    print("-----------------------------------------")
+    print("End computation")                 
 # Report elapsed real time for the analysis
 endTime = datetime.now()
 elapseTime = endTime - startTime
-print("------------------------------------------")
-print("Elapsed real time:  {}".format(elapseTime))
-print("------------------------------------------")
+if rank == 0:
+    print("------------------------------------------")
+    print("Elapsed real time:  {}".format(elapseTime))
+    print("------------------------------------------")
+
+# Store the output fields in single precision, outside of the timed
+# analysis
+MPI.barrier(MPI.comm_world)
+if rank == 0:
+    if h5py is not None:
+        downcast_results("results/3D_hip_results.xdmf")
+    else:
+        print("h5py not found: output fields are kept in double precision")
 
 '''''''''''''''''''''
 VISUALIZATION
 '''''''''''''''''''''
 
-# set plot font to size 14
-font = {'size'   : 14}
-plt.rc('font', **font)
-
-# Get array of default plot colors
-prop_cycle = plt.rcParams['axes.prop_cycle']
-colors = prop_cycle.by_key()['color']
+# Plot on the first process only
+if rank == 0:
+    # set plot font to size 14
+    font = {'size'   : 14}
+    plt.rc('font', **font)
 
-fig = plt.figure() 
-#fig.set_size_inches(7,4)
-ax=fig.gca()  
-#
-plt.plot(timeHist0, timeHist1/1.E3, linewidth=2.0,\
-         color=colors[0], marker='.')
-#-----------------------------------------------------
-#ax.set.xlim(-0.01,0.01)
-#ax.set.ylim(-0.03,0.03)
-plt.axis('tight')
-plt.grid(linestyle="--", linewidth=0.5, color='b')
-plt.ylabel(r'$P_{11}$, MPa')
-plt.xlabel(r'$\lambda$')
-#
-from matplotlib.ticker import AutoMinorLocator,FormatStrFormatter
-ax.xaxis.set_minor_locator(AutoMinorLocator())
-ax.yaxis.set_minor_locator(AutoMinorLocator())
-import matplotlib.ticker as ticker
-ax.xaxis.set_major_formatter(ticker.FormatStrFormatter('%0.2f'))
-plt.show()   
-
-
-fig = plt.gcf()
-fig.set_size_inches(7,5)
-plt.tight_layout()
-plt.savefig("results/3D_hip_stress_stretch.png", dpi=600)
+    # Get array of default plot colors
+    prop_cycle = plt.rcParams['axes.prop_cycle']
+    colors = prop_cycle.by_key()['color']
 
+    fig = plt.figure()
+    #fig.set_size_inches(7,4)
+    ax=fig.gca()
+    #
+    plt.plot(timeHist0, timeHist1/1.E3, linewidth=2.0,\
+             color=colors[0], marker='.')
+    #-----------------------------------------------------
+    #ax.set.xlim(-0.01,0.01)
+    #ax.set.ylim(-0.03,0.03)
+    plt.axis('tight')
+    plt.grid(linestyle="--", linewidth=0.5, color='b')
+    plt.ylabel(r'$P_{11}$, MPa')
+    plt.xlabel(r'$\lambda$')
+    #
+    from matplotlib.ticker import AutoMinorLocator,FormatStrFormatter
+    ax.xaxis.set_minor_locator(AutoMinorLocator())
+    ax.yaxis.set_minor_locator(AutoMinorLocator())
+    import matplotlib.ticker as ticker
+    ax.xaxis.set_major_formatter(ticker.FormatStrFormatter('%0.2f'))
+    plt.show()
+
+
+    fig = plt.gcf()
+    fig.set_size_inches(7,5)
+    plt.tight_layout()
+    plt.savefig("results/3D_hip_stress_stretch.png", dpi=600)